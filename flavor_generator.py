@@ -7,14 +7,27 @@ https://github.com/Heyzi/megalinter_flavor_generator/blob/ec51579b500636334fb591
 
 import argparse
 import base64
+import functools
+import hashlib
+import io
+import json
 import logging
+import mmap
 import os
+import re
+import string
 import subprocess
 import sys
-import textwrap
+from collections.abc import Iterable
+from concurrent.futures import ProcessPoolExecutor
+from dataclasses import dataclass
 from pathlib import Path
+from typing import TYPE_CHECKING
 
-from ruamel.yaml import YAML
+import yaml
+
+if TYPE_CHECKING:
+    from ruamel.yaml import YAML
 
 # Default values
 DEFAULT_NEW_FLAVOR = "bioinformatics"
@@ -45,6 +58,31 @@ DEFAULT_COMPONENTS = [
     "yamllint",
 ]
 
+# Files in the per-user cache directory (see _cache_dir) recording descriptor
+# state between runs
+CACHE_FILE = "descriptors.cache.json"
+STAMP_FILE = "flavor_stamp.json"
+
+# Comment marking the list_megalinter_flavors patch in flavor_factory.py
+FACTORY_PATCH_MARKER = "__flavor_generator_marker__"
+
+# Hijack and re-define list_megalinter_flavors. The previous definition is
+# bound as a default argument so that patches for several flavors can be
+# stacked without calling themselves.
+FACTORY_PATCH_TEMPLATE = string.Template(
+    "# $marker: $name\n"
+    "def list_megalinter_flavors(list_megalinter_flavors_=list_megalinter_flavors):\n"
+    "    flavors = list_megalinter_flavors_()\n"
+    "    flavors.setdefault(\n"
+    "        $name,\n"
+    "        dict(label=$label)\n"
+    "    )\n"
+    "    return flavors\n"
+)
+
+# CSafeLoader only exists when PyYAML was built against libyaml
+_FAST_LOADER = getattr(yaml, "CSafeLoader", yaml.SafeLoader)
+
 
 # Setup logging
 logging.basicConfig(
@@ -53,6 +91,166 @@ logging.basicConfig(
 logger = logging.getLogger(__name__)
 
 
+def _remove_flavors(flavors: list, to_remove: frozenset[str]) -> None:
+    """Remove flavors from a list in place, keeping the rest as they were."""
+    # Delete by index rather than rebuilding the list, so that ruamel.yaml keeps
+    # the order and comments of the remaining entries
+    for index in reversed(range(len(flavors))):
+        if flavors[index] in to_remove:
+            del flavors[index]
+
+
+@dataclass(frozen=True)
+class FlavorUpdate:
+    """A new flavor and the linters it should install."""
+
+    name: str
+    description: str
+    components: frozenset[str]
+
+    @functools.cached_property
+    def install_descriptors(self) -> frozenset[str]:
+        """Flavors that cause a linter to be installed in this flavor."""
+        return frozenset({self.name, "all_flavors"})
+
+    @functools.cached_property
+    def fingerprint(self) -> str:
+        """Identify the descriptor changes made by this update."""
+        return hashlib.sha256(
+            "\n".join([self.name, *sorted(self.components)]).encode("utf-8")
+        ).hexdigest()
+
+    @functools.cached_property
+    def reference_pattern(self) -> re.Pattern[bytes]:
+        """Match any linter or flavor name this update could add or remove."""
+        return re.compile(
+            rb"\b(?:"
+            + b"|".join(
+                re.escape(name.encode("utf-8"))
+                for name in sorted(self.components | self.install_descriptors)
+            )
+            + rb")\b"
+        )
+
+    def needs_update(self, descriptor_data: dict) -> bool:
+        """Check if apply_to_descriptor would modify a parsed descriptor."""
+        # Bind the per-flavor lookups once for the per-linter loop
+        components = self.components
+        install_descriptors = self.install_descriptors
+        new_flavor = self.name
+        any_components_present = False
+
+        for linter in descriptor_data.get("linters", []):
+            if not isinstance(linter, dict):
+                continue
+
+            linter_flavors = linter.get("descriptor_flavors") or []
+
+            if linter.get("linter_name", "") in components:
+                any_components_present = True
+                if new_flavor not in linter_flavors:
+                    return True
+            elif not install_descriptors.isdisjoint(linter_flavors):
+                return True
+
+        root_flavors = descriptor_data.get("descriptor_flavors") or []
+        return any_components_present == install_descriptors.isdisjoint(root_flavors)
+
+    def apply_to_descriptor(self, descriptor_data: dict, file_path: Path) -> bool:
+        """Add or remove this flavor from a parsed descriptor.
+
+        Returns True if the descriptor was modified.
+        """
+        components = self.components
+        install_descriptors = self.install_descriptors
+        new_flavor = self.name
+
+        modified = False
+
+        # Split the linters into those that gain the flavor and those that must
+        # lose it, keeping every linter (even duplicate or unnamed ones)
+        to_add = []
+        to_strip = []
+
+        for linter in descriptor_data.get("linters", []):
+            if not isinstance(linter, dict):
+                logger.error("Malformed linter in %s: %s", file_path.name, linter)
+            elif linter.get("linter_name", "") in components:
+                to_add.append(linter)
+            else:
+                to_strip.append(linter)
+
+        any_components_present = bool(to_add)
+
+        for linter in to_add:
+            if new_flavor not in linter.setdefault("descriptor_flavors", []):
+                linter["descriptor_flavors"].append(new_flavor)
+                modified = True
+                logger.debug(
+                    "Added %s to %s in %s",
+                    new_flavor,
+                    linter.get("linter_name", ""),
+                    file_path,
+                )
+
+                # Check if we need to update root descriptor_flavors
+                if (
+                    "install" in descriptor_data
+                    and new_flavor
+                    not in descriptor_data.setdefault("descriptor_flavors", [])
+                ):
+                    descriptor_data["descriptor_flavors"].append(new_flavor)
+                    logger.debug(
+                        "Added %s to root descriptor_flavors in %s",
+                        new_flavor,
+                        file_path,
+                    )
+
+        for linter in to_strip:
+            # We need to make sure this linter is _not_ installed. Most linters
+            # have nothing to remove, so only build a set when one does.
+            if any(
+                flavor in install_descriptors
+                for flavor in linter.get("descriptor_flavors", ())
+            ):
+                if logger.isEnabledFor(logging.DEBUG):
+                    removed = install_descriptors.intersection(
+                        linter["descriptor_flavors"]
+                    )
+                    logger.debug(
+                        "Removed %s from %s in %s",
+                        sorted(removed),
+                        linter.get("linter_name", ""),
+                        file_path,
+                    )
+
+                _remove_flavors(linter["descriptor_flavors"], install_descriptors)
+                modified = True
+
+        # Check the root descriptor_flavors
+        existing_descriptors = set(descriptor_data.get("descriptor_flavors", []))
+        descriptors_present = install_descriptors & existing_descriptors
+
+        if any_components_present and not descriptors_present:
+            # Inject the root-level descriptor
+            modified = True
+            added = sorted(install_descriptors - existing_descriptors)
+            descriptor_data.setdefault("descriptor_flavors", []).extend(added)
+            logger.debug("Added %s to root-level in %s", added, file_path)
+        elif not any_components_present and descriptors_present:
+            # Remove the root-level descriptors
+            modified = True
+            _remove_flavors(descriptor_data["descriptor_flavors"], install_descriptors)
+            if logger.isEnabledFor(logging.DEBUG):
+                logger.debug(
+                    "Removed %s from root-level in %s",
+                    sorted(descriptors_present),
+                    file_path,
+                )
+
+        return modified
+
+
 def parse_arguments() -> argparse.Namespace:
     """Parse command-line arguments."""
     parser = argparse.ArgumentParser(
@@ -76,55 +274,56 @@ def parse_arguments() -> argparse.Namespace:
         "--add-descriptor",
         action="append",
         dest="descriptors",
+        default=[],
         type=Path,
         help="New custom descriptor files to inject",
     )
+    parser.add_argument(
+        "--verbose",
+        action="store_true",
+        help="Log every change made to each descriptor",
+    )
     return parser.parse_args()
 
 
-def update_flavor_factory(
-    megalinter_repo_dir: Path, flavor_name: str, flavor_description: str
-) -> None:
+def update_flavor_factory(megalinter_repo_dir: Path, flavor: FlavorUpdate) -> None:
     """Update the flavor factory file with the new flavor if it doesn't already exist."""
     flavor_factory = megalinter_repo_dir / "megalinter" / "flavor_factory.py"
     logger.info("Updating flavor factory file: %s", flavor_factory)
 
-    content = flavor_factory.read_text(encoding="utf-8")
-
-    # Hijack and re-define the function
-    content += textwrap.dedent(f"""\
-        list_megalinter_flavors_ = list_megalinter_flavors
+    patch = FACTORY_PATCH_TEMPLATE.substitute(
+        marker=FACTORY_PATCH_MARKER,
+        name=repr(flavor.name),
+        label=repr(flavor.description),
+    )
+    marker = patch.splitlines(keepends=True)[0]
 
-        def list_megalinter_flavors():
-            flavors = list_megalinter_flavors_()
-            flavors.setdefault(
-                {repr(flavor_name)},
-                dict(label={repr(flavor_description)})
-            )
-            return flavors
-        """)
+    # Earlier patches (possibly for other flavors) may have been appended after
+    # this one, so search the whole file; it is only a few kB
+    if marker.encode("utf-8") in flavor_factory.read_bytes():
+        logger.info("'%s' flavor already in flavor_factory.py", flavor.name)
+        return
 
-    flavor_factory.write_text(content, encoding="utf-8")
-    logger.info("Added '%s' flavor in flavor_factory.py", flavor_name)
+    # Only the new definition is written; appending avoids reading and
+    # rewriting the whole file
+    with flavor_factory.open(mode="a", encoding="utf-8") as outfile:
+        outfile.write(patch)
+    logger.info("Added '%s' flavor in flavor_factory.py", flavor.name)
 
 
 def inject_yaml_descriptors(
-    megalinter_repo_dir: Path, descriptor_files: list[Path]
+    megalinter_repo_dir: Path, descriptor_files: list[Path], flavor: FlavorUpdate
 ) -> None:
     """Inject a new custom descriptor into MegaLinter."""
     descriptor_dir = megalinter_repo_dir / "megalinter" / "descriptors"
 
-    yaml = YAML()
-    yaml.preserve_quotes = True
-    yaml.indent(mapping=2, sequence=4, offset=2)
-
     for descriptor_file in descriptor_files:
         logger.info("Injecting descriptor: %s", descriptor_file)
 
         # Read in the descriptor to see if there are any python scripts to be
         # embedded
         with descriptor_file.open(mode="rb") as file:
-            descriptor_data = yaml.load(file)
+            descriptor_data = _round_trip_yaml().load(file)
 
         for linter_data in descriptor_data["linters"]:
             install_data = linter_data.get("install", {})
@@ -145,131 +344,241 @@ def inject_yaml_descriptors(
                     .strip()
                 )
 
-        with (descriptor_dir / descriptor_file.name).open(
-            mode="w", encoding="utf-8"
-        ) as outfile:
-            yaml.dump(descriptor_data, outfile)
+        # Apply the flavor now rather than in update_yaml_descriptors, so that
+        # re-injecting an unchanged descriptor leaves the file untouched
+        output_path = descriptor_dir / descriptor_file.name
+        flavor.apply_to_descriptor(descriptor_data, output_path)
 
+        buffer = io.BytesIO()
+        _round_trip_yaml().dump(descriptor_data, buffer)
 
-def update_yaml_descriptors(
-    megalinter_repo_dir: Path, components: set[str], new_flavor: str
-) -> None:
-    """Update YAML descriptor files with minimal changes."""
-    descriptor_dir = megalinter_repo_dir / "megalinter" / "descriptors"
-    logger.info("Updating YAML descriptors in %s", descriptor_dir)
+        if not output_path.is_file() or output_path.read_bytes() != buffer.getvalue():
+            _replace_file(output_path, buffer.getvalue())
 
-    yaml = YAML()
-    yaml.preserve_quotes = True
-    yaml.indent(mapping=2, sequence=4, offset=2)
 
-    install_descriptors = {new_flavor, "all_flavors"}
+@functools.cache
+def _round_trip_yaml() -> "YAML":
+    """Return the YAML handler that preserves quotes and comments."""
+    # ruamel.yaml is slow to import and its handlers are costly to build, so
+    # both are deferred until first use and then shared
+    from ruamel.yaml import YAML
 
-    for file_path in descriptor_dir.glob("*.y*ml"):
-        logger.debug("Processing file: %s", file_path)
+    round_trip_yaml = YAML()
+    round_trip_yaml.preserve_quotes = True
+    round_trip_yaml.indent(mapping=2, sequence=4, offset=2)
+    return round_trip_yaml
 
-        with file_path.open("r") as file:
-            descriptor_data = yaml.load(file)
 
-        modified = False
-        any_components_present = False
+def _cache_dir() -> Path:
+    """Return the per-user cache directory for descriptor state."""
+    cache_home = os.environ.get("XDG_CACHE_HOME") or Path.home() / ".cache"
+    return Path(cache_home, "megalinter_flavor_generator")
 
-        if not isinstance(descriptor_data, dict):
-            logger.error("Malformed descriptor file: %s", file_path.name)
-            continue
 
-        for linter in descriptor_data.get("linters", []):
-            if not isinstance(linter, dict):
-                logger.error("Malformed linter in %s: %s", file_path.name, linter)
-                continue
+def _load_state(state_file: str) -> dict:
+    """Load a JSON state file from the cache directory, or start a new one.
 
-            if (linter_name := linter.get("linter_name", "")) in components:
-                any_components_present = True
+    The cache is only an optimization, so any problem reading it is logged and
+    treated as an empty cache.
+    """
+    try:
+        state = json.loads((_cache_dir() / state_file).read_bytes())
+    except FileNotFoundError:
+        return {}
+    except (OSError, RuntimeError, ValueError) as err:
+        logger.warning("Ignoring unreadable cache file %s: %s", state_file, err)
+        return {}
 
-                if new_flavor not in linter.setdefault("descriptor_flavors", []):
-                    linter["descriptor_flavors"].append(new_flavor)
-                    modified = True
-                    logger.info(
-                        "Added %s to %s in %s", new_flavor, linter_name, file_path
-                    )
+    if not isinstance(state, dict):
+        logger.warning("Ignoring malformed cache file %s", state_file)
+        return {}
 
-                    # Check if we need to update root descriptor_flavors
-                    if (
-                        "install" in descriptor_data
-                        and new_flavor
-                        not in descriptor_data.setdefault("descriptor_flavors", [])
-                    ):
-                        descriptor_data["descriptor_flavors"].append(new_flavor)
-                        logger.info(
-                            "Added %s to root descriptor_flavors in %s",
-                            new_flavor,
-                            file_path,
-                        )
-                continue
+    return state
 
-            # We need to make sure this linter is _not_ installed
-            existing_descriptors = set(linter.get("descriptor_flavors", []))
 
-            if install_descriptors & existing_descriptors:
-                linter["descriptor_flavors"] = sorted(
-                    existing_descriptors - install_descriptors
-                )
-                modified = True
-                logger.info(
-                    "Removed %s from %s in %s",
-                    install_descriptors & existing_descriptors,
-                    linter_name,
-                    file_path,
-                )
+def _save_state(state_file: str, state: dict) -> None:
+    """Write out a JSON state file to the cache directory, if possible."""
+    try:
+        cache_dir = _cache_dir()
+        cache_dir.mkdir(parents=True, exist_ok=True)
+        _replace_file(cache_dir / state_file, json.dumps(state).encode("utf-8"))
+    except (OSError, RuntimeError) as err:
+        logger.warning("Unable to write cache file %s: %s", state_file, err)
 
-        # Check the root descriptor_flavors
-        existing_descriptors = set(descriptor_data.get("descriptor_flavors", []))
-        descriptors_present = install_descriptors & existing_descriptors
 
-        if any_components_present and not descriptors_present:
-            # Inject the root-level descriptor
-            modified = True
-            descriptor_data["descriptor_flavors"] = sorted(
-                existing_descriptors | install_descriptors
-            )
-            logger.info(
-                "Added %s to root-level in %s",
-                install_descriptors - existing_descriptors,
-                file_path,
-            )
-        elif not any_components_present and descriptors_present:
-            # Remove the root-level descriptors
-            modified = True
-            descriptor_data["descriptor_flavors"] = sorted(
-                existing_descriptors - install_descriptors
-            )
-            logger.info(
-                "Removed %s from root-level in %s",
-                install_descriptors & existing_descriptors,
-                file_path,
-            )
+def _references_any(file_path: Path, pattern: re.Pattern[bytes]) -> bool:
+    """Check if the raw bytes of a file match the pattern."""
+    with file_path.open("rb") as file:
+        # Empty files cannot be memory-mapped
+        if os.fstat(file.fileno()).st_size == 0:
+            return False
+
+        with mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ) as mapped:
+            return pattern.search(mapped) is not None
+
+
+def _process_descriptor(file_path: Path, flavor: FlavorUpdate) -> bytes | None:
+    """Add or remove the new flavor from a single YAML descriptor file.
 
-        if modified:
-            with file_path.open("w") as file:
-                yaml.dump(descriptor_data, file)
-            logger.info("Updated %s", file_path)
+    Returns the new file contents, or None if the file does not need to change.
+    """
+    logger.debug("Processing file: %s", file_path)
+
+    raw_data = file_path.read_bytes()
+
+    # Most descriptors need no changes, so decide that with the libyaml C
+    # loader and only pay for a ruamel.yaml round-trip when writing
+    fast_data = yaml.load(raw_data, Loader=_FAST_LOADER)
+
+    if not isinstance(fast_data, dict):
+        logger.error("Malformed descriptor file: %s", file_path.name)
+        return None
+
+    if not flavor.needs_update(fast_data):
+        logger.debug("No changes needed for %s", file_path)
+        return None
+
+    descriptor_yaml = _round_trip_yaml()
+    descriptor_data = descriptor_yaml.load(raw_data)
+
+    if flavor.apply_to_descriptor(descriptor_data, file_path):
+        buffer = io.BytesIO()
+        descriptor_yaml.dump(descriptor_data, buffer)
+
+        # A mutation can still round-trip to the original bytes; leave the file
+        # (and its mtime) untouched in that case
+        if (new_data := buffer.getvalue()) != raw_data:
+            return new_data
+
+    logger.debug("No changes needed for %s", file_path)
+    return None
+
+
+def _replace_file(file_path: Path, data: bytes) -> None:
+    """Replace the contents of a file in a single atomic step."""
+    # Write alongside and swap into place, so an interrupted run never leaves
+    # a truncated file behind
+    temp_path = file_path.with_suffix(file_path.suffix + ".tmp")
+    temp_path.write_bytes(data)
+    os.replace(temp_path, file_path)
+
+
+def _files_digest(file_states: Iterable[tuple[str, int, int]]) -> str:
+    """Return a digest of (path, mtime_ns, size) for a set of files."""
+    return hashlib.sha256(
+        "\n".join(
+            f"{path}\0{mtime_ns}\0{size}"
+            for path, mtime_ns, size in sorted(file_states)
+        ).encode("utf-8")
+    ).hexdigest()
+
+
+def update_yaml_descriptors(megalinter_repo_dir: Path, flavor: FlavorUpdate) -> None:
+    """Update YAML descriptor files with minimal changes."""
+    descriptor_dir = megalinter_repo_dir / "megalinter" / "descriptors"
+    logger.info("Updating YAML descriptors in %s", descriptor_dir)
+
+    with os.scandir(descriptor_dir) as entries:
+        all_files = [
+            entry
+            for entry in entries
+            if entry.name.endswith((".yml", ".yaml")) and entry.is_file()
+        ]
+
+    # If no descriptor has been touched since a previous run applied this
+    # exact flavor and component list, there is nothing to do. Files are
+    # compared by path, mtime and size only, so an edit that preserves all
+    # three (e.g. a same-size rewrite with a restored mtime) goes unnoticed.
+    stamp = {
+        "descriptor_dir": str(descriptor_dir),
+        "fingerprint": flavor.fingerprint,
+        "files": _files_digest(
+            (entry.path, entry.stat().st_mtime_ns, entry.stat().st_size)
+            for entry in all_files
+        ),
+    }
+
+    if _load_state(STAMP_FILE) == stamp:
+        logger.info("No descriptors changed since the last run")
+        return
+
+    # Otherwise, descriptors that individually have not changed on disk are
+    # already up to date
+    cache = _load_state(CACHE_FILE)
+    stale_files = []
+
+    for entry in all_files:
+        stat = entry.stat()
+        state = [stat.st_mtime_ns, stat.st_size, flavor.fingerprint]
+
+        if cache.get(entry.path) != state:
+            stale_files.append(Path(entry.path))
+
+    logger.debug(
+        "%d descriptor files unchanged since the last run",
+        len(all_files) - len(stale_files),
+    )
+
+    yaml_files = []
+
+    for file_path in stale_files:
+        # Only files that mention a targeted linter or one of the flavors we
+        # add or remove can possibly change, and a raw byte scan is far cheaper
+        # than a YAML parse
+        if _references_any(file_path, flavor.reference_pattern):
+            yaml_files.append(file_path)
         else:
-            logger.debug("No changes needed for %s", file_path)
+            logger.debug("Skipping unrelated descriptor: %s", file_path)
+
+    # Each descriptor is an independent, CPU-bound ruamel.yaml round-trip, so
+    # spread them across processes. Workers only return the new contents; all
+    # writes happen here. Workers may not inherit the log level (e.g. under
+    # "spawn"), so pass it along explicitly.
+    with ProcessPoolExecutor(
+        max_workers=os.cpu_count(),
+        initializer=logging.getLogger().setLevel,
+        initargs=(logging.getLogger().getEffectiveLevel(),),
+    ) as executor:
+        new_contents = executor.map(
+            functools.partial(_process_descriptor, flavor=flavor),
+            yaml_files,
+            chunksize=8,
+        )
+
+        modified_count = 0
+
+        for file_path, new_data in zip(yaml_files, new_contents):
+            if new_data is not None:
+                _replace_file(file_path, new_data)
+                logger.info("Updated %s", file_path)
+                modified_count += 1
+
+    # Record the post-update state of every file that was checked
+    for file_path in stale_files:
+        stat = file_path.stat()
+        cache[str(file_path)] = [stat.st_mtime_ns, stat.st_size, flavor.fingerprint]
+
+    _save_state(CACHE_FILE, cache)
+
+    stamp["files"] = _files_digest(
+        (entry.path, *cache[entry.path][:2]) for entry in all_files
+    )
+    _save_state(STAMP_FILE, stamp)
+
+    logger.info("Updated %d of %d descriptor files", modified_count, len(all_files))
 
 
 def run_build_script(megalinter_repo_dir: Path) -> None:
     """Run the build script with the correct Python path."""
     logger.info("Running build.py with PYTHONPATH set to '.'")
 
-    proc_env = os.environ.copy()
-    proc_env.update({"PYTHONPATH": "."})
-
     script_path = megalinter_repo_dir / ".automation" / "build.py"
 
     try:
         subprocess.run(
             [sys.executable, script_path],
             cwd=megalinter_repo_dir,
-            env=proc_env,
+            env={**os.environ, "PYTHONPATH": "."},
             check=True,
         )
 
@@ -289,22 +598,26 @@ def update_flavor() -> None:
     """Main function to orchestrate the update process and run the build script."""
     args = parse_arguments()
 
-    flavor_name = args.flavor_name
-    flavor_description = args.flavor_description
+    if args.verbose:
+        logging.getLogger().setLevel(logging.DEBUG)
 
-    components = {component.strip() for component in args.components}
+    flavor = FlavorUpdate(
+        name=args.flavor_name,
+        description=args.flavor_description,
+        components=frozenset(component.strip() for component in args.components),
+    )
 
-    logger.info("New flavor name: %s", flavor_name)
-    logger.info("New flavor description: %s", flavor_description)
-    logger.info("Components: %s", components)
+    logger.info("New flavor name: %s", flavor.name)
+    logger.info("New flavor description: %s", flavor.description)
+    logger.info("Components: %s", sorted(flavor.components))
 
     megalinter_repo_dir = Path(__file__).resolve().parent / "megalinter"
 
-    update_flavor_factory(megalinter_repo_dir, flavor_name, flavor_description)
+    update_flavor_factory(megalinter_repo_dir, flavor)
 
-    inject_yaml_descriptors(megalinter_repo_dir, args.descriptors)
+    inject_yaml_descriptors(megalinter_repo_dir, args.descriptors, flavor)
 
-    update_yaml_descriptors(megalinter_repo_dir, components, flavor_name)
+    update_yaml_descriptors(megalinter_repo_dir, flavor)
     logger.info("MegaLinter flavor update process completed successfully")
 
     logger.info("Starting build script execution")